@@ -1,6 +1,13 @@
+import argparse
+import datetime
+import os
 import subprocess
 import re
+import stat
 import json
+import sys
+import tempfile
+import time
 
 '''
 NodeName=erc-hpc-vm013 Arch=x86_64 CoresPerSocket=6 
@@ -23,11 +30,29 @@ NodeName=erc-hpc-vm013 Arch=x86_64 CoresPerSocket=6
    ExtSensorsJoules=n/a ExtSensorsWatts=0 ExtSensorsTemp=n/a
 '''
 
+# scontrol output shared by all the users of a login node in watch mode,
+# so N people watching only cost slurmctld one query per interval.
+# Set HPC_GPUS_CACHE_DIR to a folder writable by the group of users who
+# trust each other (e.g. setgid, mode 2770); /tmp by default.
+SCONTROL_CACHE_DIR = os.environ.get('HPC_GPUS_CACHE_DIR', tempfile.gettempdir())
+SCONTROL_CACHE_PATH = os.path.join(SCONTROL_CACHE_DIR, 'hpc-gpus-scontrol.json')
+WATCH_MIN_INTERVAL = 5
+WATCH_MAX_INTERVAL = 60
+WATCH_BACKOFF = 1.5
+CELL_WIDTH = 10
+CELL_SEPARATOR = ' | '
+# time series appended by --sample, one line per (time, gpu, partition):
+# unix_time,gpu,partition,left,count,most left on one schedulable node
+HISTORY_PATH = os.path.expanduser('~/.hpc-gpus-history.csv')
+DAYS_OF_WEEK = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+# in MB
+MEMORY_UNITS = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+# nodes in any of these states can't start new jobs
+UNAVAILABLE_STATES = {'DOWN', 'DRAIN', 'FAIL', 'MAINTENANCE', 'NOT_RESPONDING', 'RESERVED'}
 
-res = subprocess.run(["scontrol","show", "nodes", "--json"], capture_output=True, text=True)
-# print(res.stdout)
+FILTER = 'a100_80g'
+FILTER = ''
 
-scontrol_output = json.loads(res.stdout)
 
 def find(pattern, str, default=''):
    ret = default
@@ -35,87 +60,521 @@ def find(pattern, str, default=''):
    matches = re.findall(pattern, str)
    if matches:
       ret = matches[0]
-   
+
+   return ret
+
+
+def read_scontrol(max_age=0):
+   '''Returns the output of scontrol show nodes as a string.
+   If max_age > 0, reuse the shared cache when it is more recent than that
+   many seconds, otherwise refresh it.'''
+   cache_path = get_cache_path() if max_age > 0 else None
+
+   if cache_path:
+      try:
+         # an mtime in the future would keep the cache fresh forever
+         if 0 <= time.time() - os.path.getmtime(cache_path) < max_age:
+            with open(cache_path) as f:
+               return f.read()
+      except OSError:
+         pass
+
+   res = subprocess.run(["scontrol","show", "nodes", "--json"], capture_output=True, text=True, check=True)
+   ret = res.stdout
+
+   if cache_path:
+      # atomic replace, so readers never see a partial file
+      tmp_path = None
+      try:
+         fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+         with os.fdopen(fd, 'w') as f:
+            f.write(ret)
+         os.chmod(tmp_path, 0o664 if is_shared_cache_dir() else 0o644)
+         os.replace(tmp_path, cache_path)
+      except OSError:
+         if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
    return ret
 
-# sort nodes by gpu then partition
-# then count the number of available & used gpu per group
 
-partitions = set()
+def is_shared_cache_dir():
+   '''True if the cache folder is only writable by its owner and group,
+   i.e. a folder set up for a group of users who trust each other.'''
+   mode = os.stat(SCONTROL_CACHE_DIR).st_mode
+   return bool(mode & stat.S_IWGRP) and not mode & stat.S_IWOTH
+
+
+def get_cache_path():
+   '''Returns the path of the scontrol cache we can trust.
+   In a world-writable folder (e.g. /tmp) the shared file is only used if
+   it belongs to us or root, as anyone else could feed us stale or forged
+   data; otherwise we fall back to a cache of our own, under the same
+   conditions. None if neither can be trusted.'''
+   try:
+      if is_shared_cache_dir():
+         return SCONTROL_CACHE_PATH
+   except OSError:
+      return None
+
+   for path in [SCONTROL_CACHE_PATH, os.path.join(SCONTROL_CACHE_DIR, f'hpc-gpus-scontrol-{os.getuid()}.json')]:
+      try:
+         info = os.stat(path)
+      except FileNotFoundError:
+         return path
+      except OSError:
+         continue
+      if info.st_uid in (os.getuid(), 0) and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+         return path
+
+   return None
 
-stats = {
 
-}
-for node in scontrol_output['nodes']:
+def get_gpu_type(node):
+   '''Returns the gpu type of a node from its features, '' if it has none.'''
+   ret = ''
    if len(node['active_features']) > 1:
-      gpu = node['active_features'][-1]
-      if gpu == 'ib' and len(node['active_features']) > 2:
-         gpu = node['active_features'][-2]
-
-      name = node['name']
-      partition = node['partitions'][0]
-      
-      if gpu not in stats:
-         stats[gpu] = {}
-      if partition not in stats[gpu]:
-         stats[gpu][partition] = {
-            'count': 0,
-            'used': 0,
-            'left': 0,
-            'used_nodes': [],
-            'left_nodes': [],
-         }
-      
-      partitions.add(partition)
-
-      # "tres": "cpu=124,mem=755000M,billing=124,gres\/gpu=3",
-      # "tres_used": "cpu=6,gres\/gpu=3",
-
-      tres = node['tres']
-      tres_used = node['tres_used']
-      gpu_count = int(find(r'gres/gpu=(\d+)', node['tres'], 0))
-      gpu_used = int(find(r'gres/gpu=(\d+)', node['tres_used'], 0))
-      stats[gpu][partition]['count'] += gpu_count
-      stats[gpu][partition]['used'] += gpu_used
-      stats[gpu][partition]['left'] += gpu_count - gpu_used
-      if gpu_used:
-         stats[gpu][partition]['used_nodes'].append(name)
+      ret = node['active_features'][-1]
+      if ret == 'ib' and len(node['active_features']) > 2:
+         ret = node['active_features'][-2]
+   return ret
+
+
+def get_node_entries(scontrol_output):
+   '''Returns {node name: (gpu, partition, gpu count, gpu used)}'''
+   ret = {}
+
+   for node in scontrol_output['nodes']:
+      gpu = get_gpu_type(node)
+      if gpu:
+         # "tres": "cpu=124,mem=755000M,billing=124,gres\/gpu=3",
+         # "tres_used": "cpu=6,gres\/gpu=3",
+
+         gpu_count = int(find(r'gres/gpu=(\d+)', node['tres'], 0))
+         gpu_used = int(find(r'gres/gpu=(\d+)', node['tres_used'], 0))
+         ret[node['name']] = (gpu, node['partitions'][0], gpu_count, gpu_used)
+
+   return ret
+
+
+def parse_tres(tres):
+   '''"cpu=124,mem=755000M,gres/gpu=3" => {'cpu': 124, 'mem': 755000, 'gres/gpu': 3}
+   mem is in MB.'''
+   ret = {}
+   for item in (tres or '').split(','):
+      key, _, value = item.partition('=')
+      if not value:
+         continue
+      unit = value[-1].upper()
+      if key == 'mem' and unit in MEMORY_UNITS:
+         ret[key] = int(float(value[:-1]) * MEMORY_UNITS[unit])
       else:
-         stats[gpu][partition]['left_nodes'].append(name)
+         try:
+            ret[key] = int(value)
+         except ValueError:
+            pass
+   return ret
 
-FILTER = 'a100_80g'
-FILTER = ''
 
-if 0:
-   if FILTER:
-      print(json.dumps(stats[FILTER], indent=2))
-   else:
-      print(json.dumps(stats, indent=2))
+def get_node_capacities(scontrol_output):
+   '''Returns {node name: (gpu, partition, free gpus, free cpus, free mem in GB)}
+   for the gpu nodes which can accept jobs.'''
+   ret = {}
 
-# display results in a table
+   for node in scontrol_output['nodes']:
+      gpu = get_gpu_type(node)
+      states = node.get('state', [])
+      if isinstance(states, str):
+         states = [states]
+      if not gpu or UNAVAILABLE_STATES.intersection(states):
+         continue
 
-partitions = sorted([p for p in list(partitions) if p != 'cpu'])
+      total = parse_tres(node['tres'])
+      used = parse_tres(node['tres_used'])
+      mem_used = used.get('mem', node.get('alloc_memory', 0))
+      ret[node['name']] = (
+         gpu,
+         node['partitions'][0],
+         total.get('gres/gpu', 0) - used.get('gres/gpu', 0),
+         total.get('cpu', 0) - used.get('cpu', 0),
+         (total.get('mem', 0) - mem_used) // 1024,
+      )
 
-header = ['GPU']
-for partition in partitions:
-   header.append(f'left ({partition[:3]})')
-   header.append(f'max  ({partition[:3]})')
+   return ret
 
-row = ' | '.join([f'{c:>10}' for c in header])
-print(row)
 
-print('-' * len(row))
+def print_capacity(capacities, gpus, cpus, mem_gb):
+   '''Prints, per gpu & partition, how many jobs of the given shape
+   could start now, given the free resources on each node.'''
+   capacity = {}
+   for gpu, partition, free_gpus, free_cpus, free_mem in capacities.values():
+      jobs = [free_gpus // gpus]
+      if cpus:
+         jobs.append(free_cpus // cpus)
+      if mem_gb:
+         jobs.append(free_mem // mem_gb)
+      info = capacity.setdefault((gpu, partition), {'jobs': 0, 'nodes': 0, 'max_gpus': 0})
+      info['jobs'] += max(0, min(jobs))
+      info['nodes'] += 1 if min(jobs) > 0 else 0
+      info['max_gpus'] = max(info['max_gpus'], free_gpus)
 
-for gpu_key in sorted(stats):
-   info = stats[gpu_key]
-   cells = [
-      gpu_key
-   ]
+   print(f'Jobs of {gpus} gpu(s), {cpus} cpu(s), {mem_gb}GB which could start now')
+   print(f'{"GPU":>10} | {"partition":>17} | {"jobs":>6} | {"nodes":>6} | {"max gpus/node":>13}')
+   print('-' * 65)
+   for (gpu, partition), info in sorted(capacity.items()):
+      print(f'{gpu:>10} | {partition:>17} | {info["jobs"]:>6} | {info["nodes"]:>6} | {info["max_gpus"]:>13}')
+
+
+def update_stats(stats, old_entries, new_entries):
+   '''Applies to stats only the nodes which changed between
+   old_entries and new_entries. Returns True if anything changed.'''
+   ret = False
+
+   for name in set(old_entries) | set(new_entries):
+      old_entry = old_entries.get(name)
+      new_entry = new_entries.get(name)
+      if old_entry == new_entry:
+         continue
+      ret = True
+      if old_entry:
+         _add_node(stats, name, *old_entry, sign=-1)
+      if new_entry:
+         _add_node(stats, name, *new_entry)
+
+   return ret
+
+
+def _add_node(stats, name, gpu, partition, gpu_count, gpu_used, sign=1):
+   if gpu not in stats:
+      stats[gpu] = {}
+   if partition not in stats[gpu]:
+      stats[gpu][partition] = {
+         'count': 0,
+         'used': 0,
+         'left': 0,
+         'used_nodes': [],
+         'left_nodes': [],
+      }
+
+   part_info = stats[gpu][partition]
+   part_info['count'] += sign * gpu_count
+   part_info['used'] += sign * gpu_used
+   part_info['left'] += sign * (gpu_count - gpu_used)
+   nodes = part_info['used_nodes'] if gpu_used else part_info['left_nodes']
+   if sign > 0:
+      nodes.append(name)
+   else:
+      nodes.remove(name)
+
+
+def get_table(stats):
+   '''Returns the rows of the table, each row being a list of cells.'''
+   partitions = set()
+   for info in stats.values():
+      partitions.update(info)
+   partitions = sorted([p for p in list(partitions) if p != 'cpu'])
+
+   header = ['GPU']
    for partition in partitions:
-      part_info = info.get(partition, {'count': 0, 'used': 0, 'left': 0})
-      cells += [part_info['left'], part_info['count']]
+      header.append(f'left ({partition[:3]})')
+      header.append(f'max  ({partition[:3]})')
+
+   ret = [header]
+
+   for gpu_key in sorted(stats):
+      info = stats[gpu_key]
+      cells = [
+         gpu_key
+      ]
+      for partition in partitions:
+         part_info = info.get(partition, {'count': 0, 'used': 0, 'left': 0})
+         cells += [part_info['left'], part_info['count']]
 
-   row = ' | '.join([f'{c:>10}' if c else ' ' * 10 for c in cells])
+      ret.append(cells)
 
+   return ret
+
+
+def format_cell(cell):
+   return f'{cell:>{CELL_WIDTH}}' if cell else ' ' * CELL_WIDTH
+
+
+def print_table(rows):
+   row = CELL_SEPARATOR.join([f'{c:>{CELL_WIDTH}}' for c in rows[0]])
    print(row)
 
+   print('-' * len(row))
+
+   for cells in rows[1:]:
+      print(CELL_SEPARATOR.join([format_cell(c) for c in cells]))
+
+
+def redraw_table(rows, previous_rows):
+   '''Rewrites only the cells that differ from previous_rows.
+   Falls back to a full redraw when the shape or the header of the table changed.'''
+   if previous_rows is None or [r[0] for r in rows] != [r[0] for r in previous_rows] \
+         or rows[0] != previous_rows[0]:
+      # clear screen, cursor home
+      sys.stdout.write('\033[2J\033[H')
+      print_table(rows)
+      return
+
+   # table lines: header, separator, then one per gpu
+   for r, cells in enumerate(rows[1:]):
+      for c, cell in enumerate(cells):
+         if cell != previous_rows[r + 1][c]:
+            column = c * (CELL_WIDTH + len(CELL_SEPARATOR)) + 1
+            sys.stdout.write(f'\033[{r + 3};{column}H{format_cell(cell)}')
+
+
+def watch(interval):
+   interval = max(interval, WATCH_MIN_INTERVAL)
+   delay = interval
+   stats = {}
+   entries = {}
+   rows = None
+
+   while True:
+      status = ''
+      try:
+         new_entries = get_node_entries(json.loads(read_scontrol(max_age=interval)))
+      except (subprocess.CalledProcessError, ValueError, OSError) as e:
+         status = f'ERROR: {e}'
+         new_entries = None
+
+      if new_entries is not None and update_stats(stats, entries, new_entries):
+         entries = new_entries
+         new_rows = get_table(stats)
+         redraw_table(new_rows, rows)
+         rows = new_rows
+         delay = interval
+      else:
+         # back off while nothing changes or scontrol fails
+         delay = min(delay * WATCH_BACKOFF, WATCH_MAX_INTERVAL)
+
+      line = len(rows) + 3 if rows else 1
+      status = status or f'updated {time.strftime("%H:%M:%S")}'
+      sys.stdout.write(f'\033[{line};1H\033[K{status}, next in {delay:.0f}s')
+      sys.stdout.flush()
+
+      time.sleep(delay)
+
+
+def get_max_free_gpus(capacities):
+   '''Returns {(gpu, partition): most free gpus on a single node}.'''
+   ret = {}
+   for gpu, partition, free_gpus, _, _ in capacities.values():
+      ret[(gpu, partition)] = max(ret.get((gpu, partition), 0), free_gpus)
+   return ret
+
+
+def append_history(stats, max_free, path, now=None):
+   now = int(now or time.time())
+   with open(path, 'a') as f:
+      for gpu in sorted(stats):
+         for partition, part_info in sorted(stats[gpu].items()):
+            f.write(f'{now},{gpu},{partition},{part_info["left"]},{part_info["count"]},{max_free.get((gpu, partition), 0)}\n')
+
+
+def read_history(path):
+   '''Returns {(gpu, partition): [(unix_time, left, count, max_free), ...]} sorted by time'''
+   ret = {}
+   malformed = []
+   with open(path) as f:
+      for i, line in enumerate(f, 1):
+         parts = line.strip().split(',')
+         try:
+            if len(parts) != 6:
+               raise ValueError
+            sample = (int(parts[0]), int(parts[3]), int(parts[4]), int(parts[5]))
+         except ValueError:
+            malformed.append(i)
+            continue
+         ret.setdefault((parts[1], parts[2]), []).append(sample)
+
+   if malformed:
+      print(f'WARNING: skipped {len(malformed)} malformed line(s) of {path}: {", ".join(map(str, malformed[:10]))}')
+
+   for samples in ret.values():
+      samples.sort()
+
+   return ret
+
+
+def percentile(values, p):
+   '''Nearest-rank percentile of a list of numbers, None if empty.'''
+   if not values:
+      return None
+   values = sorted(values)
+   return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def get_hour_of_week(unix_time):
+   dt = datetime.datetime.fromtimestamp(unix_time)
+   return dt.weekday() * 24 + dt.hour
+
+
+def get_waits(samples, gpus):
+   '''Returns [(unix_time, seconds until at least gpus were free on one node)]
+   for each sample; 0 if they were already free at that time.
+   Samples after the last time gpus were free are ignored.'''
+   ret = []
+   next_available = None
+   for unix_time, _, _, max_free in reversed(samples):
+      if max_free >= gpus:
+         next_available = unix_time
+      if next_available is not None:
+         ret.append((unix_time, next_available - unix_time))
+
+   ret.reverse()
+   return ret
+
+
+def print_report(history, gpus, gpu_filter='', pct=50):
+   '''Prints, per gpu & partition, the distribution of left gpus,
+   how often and how long one waits for gpus of that type on a single node.
+   With gpu_filter, also prints the pct percentile of left gpus by hour of week.'''
+   this_hour = get_hour_of_week(time.time())
+
+   print(f'{"GPU":>10} | {"partition":>17} | {"p10":>4} {"p50":>4} {"p90":>4} | {"p50 now":>7} | {f"P(>={gpus})":>7} | {"wait":>8} | {"wait now":>8}')
+   print('-' * 92)
+   for (gpu, partition), samples in sorted(history.items()):
+      if gpu_filter and gpu != gpu_filter:
+         continue
+      lefts = [left for _, left, _, _ in samples]
+      lefts_now = [left for t, left, _, _ in samples if get_hour_of_week(t) == this_hour]
+      available = sum(1 for _, _, _, max_free in samples if max_free >= gpus) / len(samples)
+      waits = get_waits(samples, gpus)
+      wait = _format_wait([w for _, w in waits])
+      wait_now = _format_wait([w for t, w in waits if get_hour_of_week(t) == this_hour])
+      p10, p50, p90 = [percentile(lefts, p) for p in (10, 50, 90)]
+      p50_now = percentile(lefts_now, 50)
+      print(f'{gpu:>10} | {partition:>17} | {p10:>4} {p50:>4} {p90:>4} | {_format_value(p50_now):>7} | {available:>7.0%} | {wait:>8} | {wait_now:>8}')
+
+   if not gpu_filter:
+      return
+
+   for (gpu, partition), samples in sorted(history.items()):
+      if gpu != gpu_filter:
+         continue
+      by_hour = {}
+      for unix_time, left, _, _ in samples:
+         by_hour.setdefault(get_hour_of_week(unix_time), []).append(left)
+
+      print(f'\n{gpu} ({partition}), p{pct} of left gpus by hour of week')
+      print('    ' + ''.join([f'{hour:>4}' for hour in range(24)]))
+      for day, day_name in enumerate(DAYS_OF_WEEK):
+         cells = [_format_value(percentile(by_hour.get(day * 24 + hour, []), pct)) for hour in range(24)]
+         print(f'{day_name} ' + ''.join([f'{cell:>4}' for cell in cells]))
+
+
+def _format_value(value):
+   return '-' if value is None else str(value)
+
+
+def _format_wait(waits):
+   '''Mean wait in minutes, or '-' if unknown.'''
+   if not waits:
+      return '-'
+   return f'{sum(waits) / len(waits) / 60:.0f}min'
+
+
+def parse_capacity(value):
+   '''argparse type of --capacity: "G,C,M" -> (gpus, cpus, mem_gb).'''
+   try:
+      gpus, cpus, mem_gb = [int(v) for v in value.split(',')]
+   except ValueError:
+      raise argparse.ArgumentTypeError(f'expected G,C,M as three integers, e.g. 4,16,64, got "{value}"')
+   if gpus < 1 or cpus < 0 or mem_gb < 0:
+      raise argparse.ArgumentTypeError(f'expected at least 1 gpu and no negative cpus or memory, got "{value}"')
+   return gpus, cpus, mem_gb
+
+
+def parse_gpus(value):
+   '''argparse type of --gpus: at least 1.'''
+   ret = int(value)
+   if ret < 1:
+      raise argparse.ArgumentTypeError(f'expected at least 1 gpu, got "{value}"')
+   return ret
+
+
+def parse_percentile(value):
+   '''argparse type of --percentile: 0 to 100.'''
+   ret = int(value)
+   if not 0 <= ret <= 100:
+      raise argparse.ArgumentTypeError(f'expected a percentile from 0 to 100, got "{value}"')
+   return ret
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Shows number of available gpus per type on SLURM cluster.')
+   parser.add_argument('-w', '--watch', type=float, metavar='SECONDS',
+      help=f'refresh the table every SECONDS (min {WATCH_MIN_INTERVAL}), backing off up to {WATCH_MAX_INTERVAL}s while nothing changes')
+   parser.add_argument('-s', '--sample', action='store_true',
+      help='append the current numbers to the history file instead of showing them (e.g. from a cron job)')
+   parser.add_argument('-r', '--report', action='store_true',
+      help='show availability percentiles and expected waits from the history file')
+   parser.add_argument('-g', '--gpu', default='',
+      help='only report on that gpu type, with percentiles by hour of week')
+   parser.add_argument('-n', '--gpus', type=parse_gpus, default=1,
+      help='number of gpus to wait for in the report (default: 1)')
+   parser.add_argument('-p', '--percentile', type=parse_percentile, default=50,
+      help='percentile shown by hour of week in the report (default: 50)')
+   parser.add_argument('--history', default=HISTORY_PATH,
+      help=f'path of the history file (default: {HISTORY_PATH})')
+   parser.add_argument('-c', '--capacity', metavar='G,C,M', type=parse_capacity,
+      help='show how many jobs of G gpus, C cpus and M GB of memory could start now, per gpu type')
+   parser.add_argument('-i', '--input',
+      help='read nodes from this recorded `scontrol show nodes --json` file instead of calling scontrol')
+   args = parser.parse_args()
+
+   if args.watch and (args.capacity or args.input):
+      parser.error('--watch always shows the live table, it can\'t be combined with --capacity or --input')
+
+   if args.report:
+      try:
+         history = read_history(args.history)
+      except FileNotFoundError:
+         print(f'No history in {args.history} yet, sample it first with --sample (e.g. from a cron job).')
+         return
+      print_report(history, args.gpus, args.gpu, args.percentile)
+      return
+
+   if args.watch:
+      try:
+         watch(args.watch)
+      except KeyboardInterrupt:
+         print()
+      return
+
+   # sort nodes by gpu then partition
+   # then count the number of available & used gpu per group
+   if args.input:
+      with open(args.input) as f:
+         scontrol_output = json.load(f)
+   else:
+      scontrol_output = json.loads(read_scontrol())
+
+   if args.capacity:
+      print_capacity(get_node_capacities(scontrol_output), *args.capacity)
+      return
+
+   stats = {}
+   update_stats(stats, {}, get_node_entries(scontrol_output))
+
+   if args.sample:
+      append_history(stats, get_max_free_gpus(get_node_capacities(scontrol_output)), args.history)
+      return
+
+   if 0:
+      if FILTER:
+         print(json.dumps(stats[FILTER], indent=2))
+      else:
+         print(json.dumps(stats, indent=2))
+
+   # display results in a table
+   print_table(get_table(stats))
+
+
+if __name__ == '__main__':
+   main()
@@ -9,36 +9,95 @@ It was written by Brave AI with following prompt:
 "a python script that kills processes which have more than x GB of allocated VRAM on local GPU but haven't done any compute on the GPU for y minutes"
 '''
 
+import argparse
+import ctypes
+import hmac
+import json
+import pwd
 import subprocess
 import time
 import os
 import signal
+import socket
+import socketserver
+import threading
+from collections import deque
 from datetime import datetime
 
+try:
+    # optional, see FLEET CONFIGURATION below
+    import env.kill_gpu_hoarder as settings
+except ImportError:
+    settings = None
+
 # --- CONFIGURATION ---
 VRAM_THRESHOLD_GB = 2  # Kill if process uses more than this many GB
-INACTIVE_LIMIT_MINUTES = 10  # Kill if 0% compute for this long
+INACTIVE_LIMIT_MINUTES = 10  # Kill if mostly idle (see MAX_DUTY_CYCLE) for this long
 # CHECK_INTERVAL_SECONDS = 60  # How often to check
 CHECK_INTERVAL_SECONDS = 5  # How often to check
 
-# Tracker: {pid: last_active_timestamp}
-idle_tracker = {}
+# A longer gap between two samples of a process (failed reads, agent
+# disconnected) restarts its history, so a few samples never decide a kill
+MAX_SAMPLE_GAP_SECONDS = 3 * CHECK_INTERVAL_SECONDS
+
+# Kill if the process used the GPU in no more than this share of the
+# samples over the last INACTIVE_LIMIT_MINUTES (0.05 = 5%)
+MAX_DUTY_CYCLE = 0.05
+# Never kill a process seen for less than this, even if idle over a whole
+# window (a process is never killed before INACTIVE_LIMIT_MINUTES anyway)
+GRACE_MINUTES = 0
+# One JSON line per kill with the samples that led to it
+AUDIT_LOG_PATH = '/var/log/kill-gpu-hoarder.jsonl'
+
+# --- FLEET CONFIGURATION (--collector) ---
+# Read from env/kill_gpu_hoarder.py on the collector, if any:
+# DEFAULT_POLICY: overrides of the policy above for the whole fleet
+# PARTITION_POLICIES: overrides by partition (as given to the agents with --partition)
+# USER_POLICIES: then overrides by user name
+# e.g. PARTITION_POLICIES = {'interruptible_gpu': {'inactive_limit_minutes': 5, 'grace_minutes': 30}}
+# FLEET_TOKEN: secret shared by the collector and its agents, sent with
+# every message; the KILL_GPU_HOARDER_TOKEN environment variable overrides it
+PARTITION_POLICIES = getattr(settings, 'PARTITION_POLICIES', {})
+USER_POLICIES = getattr(settings, 'USER_POLICIES', {})
+COLLECTOR_TIMEOUT_SECONDS = 10
+FLEET_TOKEN = os.environ.get('KILL_GPU_HOARDER_TOKEN', getattr(settings, 'FLEET_TOKEN', ''))
+
+DEFAULT_POLICY = {
+    'vram_threshold_gb': VRAM_THRESHOLD_GB,
+    'inactive_limit_minutes': INACTIVE_LIMIT_MINUTES,
+    'max_duty_cycle': MAX_DUTY_CYCLE,
+    'grace_minutes': GRACE_MINUTES,
+}
+DEFAULT_POLICY.update(getattr(settings, 'DEFAULT_POLICY', {}))
+
+# Tracker: {pid: deque of recent (timestamp, util, mem_gb) samples}
+history = {}
+# long enough for the longest window or grace period of any policy
+HISTORY_LENGTH = max(
+    policy.get(name, 0)
+    for policy in [DEFAULT_POLICY] + list(PARTITION_POLICIES.values()) + list(USER_POLICIES.values())
+    for name in ['inactive_limit_minutes', 'grace_minutes']
+) * 60 // CHECK_INTERVAL_SECONDS + 1
 
 def log(message):
     """Prints a message with a current timestamp prefix."""
     timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
     print(f"{timestamp} {message}")
 
-def get_gpu_stats():
-    """Returns a dict of {pid: {'mem_gb': float, 'util': int}}"""
-    stats = {}
-    try:
+class NvidiaSmiSampler:
+    """Reads GPU stats by parsing the output of two nvidia-smi calls."""
+
+    name = 'nvidia-smi'
+
+    def sample(self):
+        """Returns a dict of {pid: {'mem_gb': float, 'util': int}}"""
+        stats = {}
         # Get memory usage: pid, used_gpu_memory (MiB)
         mem_raw = subprocess.check_output(
             ['nvidia-smi', '--query-compute-apps=pid,used_memory', '--format=csv,noheader,nounits'],
             encoding='utf-8'
         ).strip()
-        
+
         for line in mem_raw.split('\n'):
             if not line: continue
             pid, mem_mib = map(int, line.split(','))
@@ -49,7 +108,7 @@ def get_gpu_stats():
             ['nvidia-smi', 'pmon', '-c', '1', '-s', 'u'],
             encoding='utf-8'
         ).strip().split('\n')
-        
+
         # skip headers
         for line in pmon_raw[2:]:
             parts = line.split()
@@ -61,47 +120,442 @@ def get_gpu_stats():
                         stats[pid]['util'] = sm_util
                 except ValueError:
                     continue
+        return stats
+
+
+class NvmlProcessInfo(ctypes.Structure):
+    # nvmlProcessInfo_t, as returned by nvmlDeviceGetComputeRunningProcesses_v3
+    _fields_ = [
+        ('pid', ctypes.c_uint),
+        ('usedGpuMemory', ctypes.c_ulonglong),
+        ('gpuInstanceId', ctypes.c_uint),
+        ('computeInstanceId', ctypes.c_uint),
+    ]
+
+
+class NvmlProcessUtilizationSample(ctypes.Structure):
+    # nvmlProcessUtilizationSample_t
+    _fields_ = [
+        ('pid', ctypes.c_uint),
+        ('timeStamp', ctypes.c_ulonglong),
+        ('smUtil', ctypes.c_uint),
+        ('memUtil', ctypes.c_uint),
+        ('encUtil', ctypes.c_uint),
+        ('decUtil', ctypes.c_uint),
+    ]
+
+
+class NvmlSampler:
+    """Reads GPU stats in-process from the NVIDIA Management Library.
+    Utilisation is the highest %sm reported by the driver since the
+    previous call, so short bursts between two checks are not missed.
+    """
+
+    name = 'nvml'
+
+    NVML_SUCCESS = 0
+    NVML_ERROR_NOT_FOUND = 6
+    NVML_ERROR_INSUFFICIENT_SIZE = 7
+    NVML_VALUE_NOT_AVAILABLE = 2 ** 64 - 1
+
+    def __init__(self, library='libnvidia-ml.so.1'):
+        # raises OSError if the library is missing
+        self.nvml = ctypes.CDLL(library)
+        # raises AttributeError with drivers older than 510
+        self.get_processes = self.nvml.nvmlDeviceGetComputeRunningProcesses_v3
+        self._check(self.nvml.nvmlInit_v2())
+        count = ctypes.c_uint()
+        self._check(self.nvml.nvmlDeviceGetCount_v2(ctypes.byref(count)))
+        self.devices = []
+        for i in range(count.value):
+            device = ctypes.c_void_p()
+            self._check(self.nvml.nvmlDeviceGetHandleByIndex_v2(i, ctypes.byref(device)))
+            self.devices.append(device)
+        # microseconds timestamp of the last utilisation sample per device
+        self.last_seen = [0] * len(self.devices)
+
+    def _check(self, ret):
+        if ret != self.NVML_SUCCESS:
+            self.nvml.nvmlErrorString.restype = ctypes.c_char_p
+            raise RuntimeError(f"NVML error {ret}: {self.nvml.nvmlErrorString(ret).decode()}")
+
+    def _get_processes(self, device):
+        count = ctypes.c_uint(0)
+        ret = self.get_processes(device, ctypes.byref(count), None)
+        if ret == self.NVML_SUCCESS:
+            return []
+        if ret != self.NVML_ERROR_INSUFFICIENT_SIZE:
+            self._check(ret)
+        # a few spare slots in case processes started in between
+        count.value += 4
+        infos = (NvmlProcessInfo * count.value)()
+        self._check(self.get_processes(device, ctypes.byref(count), infos))
+        return infos[:count.value]
+
+    def _get_utilization(self, i):
+        device = self.devices[i]
+        count = ctypes.c_uint(0)
+        last_seen = ctypes.c_ulonglong(self.last_seen[i])
+        ret = self.nvml.nvmlDeviceGetProcessUtilization(device, None, ctypes.byref(count), last_seen)
+        if ret in [self.NVML_SUCCESS, self.NVML_ERROR_NOT_FOUND]:
+            return []
+        if ret != self.NVML_ERROR_INSUFFICIENT_SIZE:
+            self._check(ret)
+        # a few spare slots in case processes started in between
+        count.value += 4
+        samples = (NvmlProcessUtilizationSample * count.value)()
+        ret = self.nvml.nvmlDeviceGetProcessUtilization(device, samples, ctypes.byref(count), last_seen)
+        if ret == self.NVML_ERROR_NOT_FOUND:
+            return []
+        self._check(ret)
+        return samples[:count.value]
+
+    def sample(self):
+        """Returns a dict of {pid: {'mem_gb': float, 'util': int}}"""
+        stats = {}
+        for i, device in enumerate(self.devices):
+            for process in self._get_processes(device):
+                mem = process.usedGpuMemory
+                if mem == self.NVML_VALUE_NOT_AVAILABLE:
+                    mem = 0
+                stat = stats.setdefault(process.pid, {'mem_gb': 0, 'util': 0})
+                stat['mem_gb'] += mem / 1024 ** 3
+
+            for sample in self._get_utilization(i):
+                self.last_seen[i] = max(self.last_seen[i], sample.timeStamp)
+                if sample.pid in stats:
+                    stats[sample.pid]['util'] = max(stats[sample.pid]['util'], sample.smUtil)
+        return stats
+
+
+def get_sampler():
+    """Returns the NVML sampler, or the nvidia-smi one if NVML can't be loaded."""
+    try:
+        return NvmlSampler()
+    except (OSError, AttributeError, RuntimeError) as e:
+        log(f"NVML not available ({e}), falling back to nvidia-smi.")
+        return NvidiaSmiSampler()
+
+
+def get_gpu_stats(sampler):
+    """Returns a dict of {pid: {'mem_gb': float, 'util': int}},
+    None if the GPUs couldn't be read."""
+    try:
+        return sampler.sample()
     except Exception as e:
         log(f"Error reading GPU stats: {e}")
-    return stats
+        return None
+
+
+def get_policy(user=None, partition=None):
+    ret = dict(DEFAULT_POLICY)
+    ret.update(PARTITION_POLICIES.get(partition, {}))
+    ret.update(USER_POLICIES.get(user, {}))
+    return ret
+
+
+def get_idle_evidence(samples, now, policy):
+    """Returns a summary of the samples of a process if they show it has been
+    hoarding VRAM while mostly idle for the inactive limit of the policy,
+    None otherwise or during its grace period."""
+    window_start = now - policy['inactive_limit_minutes'] * 60
+    if not samples or samples[0][0] > min(window_start, now - policy['grace_minutes'] * 60):
+        return None
+    samples = [sample for sample in samples if sample[0] >= window_start]
+    utils = [util for _, util, _ in samples]
+    mems = [mem_gb for _, _, mem_gb in samples]
+    duty_cycle = sum(1 for util in utils if util > 0) / len(utils)
+    if min(mems) <= policy['vram_threshold_gb'] or duty_cycle > policy['max_duty_cycle']:
+        return None
+    return {
+        'since': datetime.fromtimestamp(samples[0][0]).isoformat(),
+        'samples': len(samples),
+        'duty_cycle': round(duty_cycle, 3),
+        'mean_util': round(sum(utils) / len(utils), 1),
+        'min_mem_gb': round(min(mems), 2),
+        'max_mem_gb': round(max(mems), 2),
+        'utils': utils,
+    }
+
+
+def track_sample(history, key, label, data, now, policy):
+    """Adds a sample to the history of a process and returns
+    the evidence for killing it, if any."""
+    if key in history and history[key] and now - history[key][-1][0] > MAX_SAMPLE_GAP_SECONDS:
+        log(f"[GAP] {label} not sampled for {now - history[key][-1][0]:.0f}s, restarting its history.")
+        del history[key]
+    if key not in history:
+        history[key] = deque(maxlen=HISTORY_LENGTH)
+        if data['mem_gb'] > policy['vram_threshold_gb']:
+            log(f"[TRACKING] {label} is heavy ({data['mem_gb']:.2f}GB).")
+    samples = history[key]
+    samples.append((now, data['util'], data['mem_gb']))
+    return get_idle_evidence(samples, now, policy)
+
+
+def kill(pid, evidence):
+    """Terminates the process and records why. Returns False if it was already gone."""
+    log(f"[KILL] PID {pid} active in {evidence['duty_cycle']:.0%} of {evidence['samples']} samples since {evidence['since']}. Terminating...")
+    # read before the signal, /proc/{pid} may be gone right after it
+    process = get_process_info(pid)
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return False
+    write_audit(pid, evidence, process)
+    return True
+
+
+def get_user(pid):
+    try:
+        return pwd.getpwuid(os.stat(f'/proc/{pid}').st_uid).pw_name
+    except (OSError, KeyError):
+        return ''
+
+
+def get_process_info(pid):
+    """Returns {'cmdline': str, 'uid': int} of a running process, as far as known."""
+    ret = {}
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            ret['cmdline'] = f.read().replace(b'\0', b' ').decode(errors='replace').strip()
+        ret['uid'] = os.stat(f'/proc/{pid}').st_uid
+    except OSError:
+        pass
+    return ret
+
+
+def write_audit(pid, evidence, process):
+    """Appends the evidence for a kill to the audit log."""
+    entry = {'time': datetime.now().isoformat(), 'pid': pid}
+    entry.update(process)
+    entry.update(evidence)
+    try:
+        with open(AUDIT_LOG_PATH, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        log(f"Error writing audit log: {e}")
+
+
+def main(sampler=None):
+    """Checks GPU processes forever.
+    sampler is any object with a sample() method returning
+    {pid: {'mem_gb': float, 'util': int}}, by default NVML or nvidia-smi.
+    """
+    sampler = sampler or get_sampler()
+    policy = get_policy()
+    log(f"Monitoring GPU for processes > {VRAM_THRESHOLD_GB}GB VRAM and active in <= {MAX_DUTY_CYCLE:.0%} of the last {INACTIVE_LIMIT_MINUTES}min...")
 
-def main():
-    log(f"Monitoring GPU for processes > {VRAM_THRESHOLD_GB}GB VRAM and idle for > {INACTIVE_LIMIT_MINUTES}min...")
-    
     while True:
-        current_stats = get_gpu_stats()
+        current_stats = get_gpu_stats(sampler)
         now = time.time()
-        
+        # a failed read says nothing about the processes, keep their history
+        if current_stats is None:
+            time.sleep(CHECK_INTERVAL_SECONDS)
+            continue
+
         # Clean up tracker for processes that finished on their own
-        tracked_pids = list(idle_tracker.keys())
+        tracked_pids = list(history.keys())
         for pid in tracked_pids:
             if pid not in current_stats:
-                del idle_tracker[pid]
+                del history[pid]
 
         for pid, data in current_stats.items():
-            is_heavy = data['mem_gb'] > VRAM_THRESHOLD_GB
-            is_idle = data['util'] == 0
-           
-            if is_heavy and is_idle:
-                if pid not in idle_tracker:
-                    idle_tracker[pid] = now
-                    log(f"[TRACKING] PID {pid} is heavy ({data['mem_gb']:.2f}GB) and idle.")
-                else:
-                    idle_time_min = (now - idle_tracker[pid]) / 60
-                    if idle_time_min >= INACTIVE_LIMIT_MINUTES:
-                        log(f"[KILL] PID {pid} idle for {idle_time_min:.1f}min. Terminating...")
-                        try:
-                            os.kill(pid, signal.SIGTERM)
-                            del idle_tracker[pid]
-                        except ProcessLookupError:
-                            pass
-            else:
-                # Process is either light or currently working
-                if pid in idle_tracker:
-                    log(f"[RESET] PID {pid} is active (util {data['util']}%) or freed memory.")
-                    del idle_tracker[pid]
+            evidence = track_sample(history, pid, f"PID {pid}", data, now, policy)
+            if evidence and kill(pid, evidence):
+                del history[pid]
 
         time.sleep(CHECK_INTERVAL_SECONDS)
 
+
+def run_agent(address, node, partition, sampler=None):
+    """Sends the GPU stats of this node to the collector every
+    CHECK_INTERVAL_SECONDS and kills the processes it asks for.
+
+    Message sent, one JSON line per check:
+    {"token": FLEET_TOKEN, "node": name, "partition": name, "procs": [[pid, util, mem_gb, user], ...]}
+    Reply: {"kill": [[pid, evidence], ...]}
+    """
+    sampler = sampler or get_sampler()
+    log(f"Agent {node} reporting to collector {address[0]}:{address[1]}...")
+    sock = None
+    reachable = True
+
+    while True:
+        current_stats = get_gpu_stats(sampler)
+        # an empty report would make the collector forget this node's processes
+        if current_stats is None:
+            time.sleep(CHECK_INTERVAL_SECONDS)
+            continue
+        message = {
+            'token': FLEET_TOKEN,
+            'node': node,
+            'partition': partition,
+            'procs': [
+                [pid, data['util'], round(data['mem_gb'], 2), get_user(pid)]
+                for pid, data in current_stats.items()
+            ],
+        }
+        reply = {'kill': []}
+        try:
+            if sock is None:
+                sock = socket.create_connection(address, timeout=COLLECTOR_TIMEOUT_SECONDS)
+                stream = sock.makefile('rw')
+            stream.write(json.dumps(message) + '\n')
+            stream.flush()
+            reply = json.loads(stream.readline())
+            if not reachable:
+                log("Collector reachable again, enforcing its policy.")
+                reachable = True
+        except (OSError, ValueError) as e:
+            # the collector also closes the connection if it rejects the agent
+            if reachable:
+                log(f"[WARNING] Collector unreachable or rejecting this agent ({e}): NO POLICY IS ENFORCED on {node} until it is back.")
+                reachable = False
+            if sock is not None:
+                sock.close()
+            sock = None
+
+        for pid, evidence in reply['kill']:
+            # never trust the collector with processes we didn't report
+            if pid in current_stats:
+                kill(pid, evidence)
+
+        time.sleep(CHECK_INTERVAL_SECONDS)
+
+
+class CollectorHandler(socketserver.StreamRequestHandler):
+    """One connection per agent, one JSON line per check in each direction.
+    The first message claims its node for the whole connection."""
+
+    # drop silent agents, so a dead connection doesn't keep its node claimed
+    timeout = 3 * CHECK_INTERVAL_SECONDS + COLLECTOR_TIMEOUT_SECONDS
+
+    def handle(self):
+        address = self.client_address[0]
+        node = None
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                    token = str(message['token']).encode()
+                    if not isinstance(message['node'], str):
+                        raise ValueError('node is not a string')
+                except (ValueError, TypeError, KeyError) as e:
+                    log(f"[REJECTED] {address}: malformed message ({e!r})")
+                    break
+                if not hmac.compare_digest(token, FLEET_TOKEN.encode()):
+                    log(f"[REJECTED] {address}: wrong token")
+                    break
+                if node is None:
+                    if not self.server.claim(message['node']):
+                        log(f"[REJECTED] {address}: {message['node']} is already connected")
+                        break
+                    node = message['node']
+                elif message['node'] != node:
+                    log(f"[REJECTED] {address}: {node} reported as {message['node']}")
+                    break
+                try:
+                    kills = self.server.check(message)
+                except (ValueError, TypeError, KeyError) as e:
+                    log(f"[REJECTED] {node}: malformed processes ({e!r})")
+                    break
+                self.wfile.write((json.dumps({'kill': kills}) + '\n').encode())
+        except OSError as e:
+            log(f"Error talking to {node or address}: {e}")
+        finally:
+            if node is not None:
+                self.server.release(node)
+                log(f"[DISCONNECTED] {node}")
+
+
+class Collector(socketserver.ThreadingTCPServer):
+    """Keeps the samples of all the nodes and applies the fleet policies."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, CollectorHandler)
+        self.lock = threading.Lock()
+        # {(node, pid): deque of recent (timestamp, util, mem_gb) samples}
+        self.history = {}
+        # nodes with a live agent connection
+        self.nodes = set()
+
+    def claim(self, node):
+        """Returns False if another connection already reports for that node."""
+        with self.lock:
+            if node in self.nodes:
+                return False
+            self.nodes.add(node)
+            return True
+
+    def release(self, node):
+        """Forgets the node's processes, which can't be watched until it reconnects."""
+        with self.lock:
+            self.nodes.discard(node)
+            for key in list(self.history.keys()):
+                if key[0] == node:
+                    del self.history[key]
+
+    def check(self, message):
+        """Returns [[pid, evidence], ...] to kill on the node of the message."""
+        ret = []
+        now = time.time()
+        node = message['node']
+        pids = [proc[0] for proc in message['procs']]
+
+        with self.lock:
+            # Clean up tracker for processes that finished on their own
+            for key in list(self.history.keys()):
+                if key[0] == node and key[1] not in pids:
+                    del self.history[key]
+
+            for pid, util, mem_gb, user in message['procs']:
+                policy = get_policy(user, message['partition'])
+                data = {'util': util, 'mem_gb': mem_gb}
+                label = f"{node} PID {pid} ({user})"
+                evidence = track_sample(self.history, (node, pid), label, data, now, policy)
+                if evidence:
+                    log(f"[KILL] {label} active in {evidence['duty_cycle']:.0%} of {evidence['samples']} samples.")
+                    evidence.update({'node': node, 'user': user})
+                    ret.append([pid, evidence])
+                    del self.history[(node, pid)]
+
+        return ret
+
+
+def run_collector(address):
+    log(f"Collector listening on {address[0] or '*'}:{address[1]}...")
+    with Collector(address) as server:
+        server.serve_forever()
+
+
+def parse_address(address):
+    """'host:port' or 'port' => (host, port), host defaults to 127.0.0.1"""
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Kills processes which hoard GPU VRAM while idle.')
+    parser.add_argument('--collector', metavar='[HOST:]PORT',
+        help='run as the fleet collector, listening on that address (default host: 127.0.0.1)')
+    parser.add_argument('--agent', metavar='HOST:PORT',
+        help='run as a node agent sending its samples to the collector at that address')
+    parser.add_argument('--node', default=socket.gethostname(),
+        help='name of this node reported by the agent (default: hostname)')
+    parser.add_argument('--partition', default='',
+        help='partition of this node reported by the agent')
+    args = parser.parse_args()
+
+    if (args.collector or args.agent) and not FLEET_TOKEN:
+        parser.error('set the same secret in KILL_GPU_HOARDER_TOKEN (or FLEET_TOKEN in env/kill_gpu_hoarder.py) for the collector and its agents')
+
+    if args.collector:
+        run_collector(parse_address(args.collector))
+    elif args.agent:
+        run_agent(parse_address(args.agent), args.node, args.partition)
+    else:
+        main()
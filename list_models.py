@@ -1,13 +1,87 @@
+import argparse
 import json
+import os
 import ssl
+import threading
+import time
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from env.list_models import API_URL, TOKEN
+import env.list_models as settings
 
-IS_ER_API = True
+# Endpoints to list, each with the schema of its response (see SCHEMAS).
+# Set ENDPOINTS in env/list_models.py to query several gateways, e.g.
+# ENDPOINTS = [
+#     {'name': 'er', 'url': 'https://...', 'token': '...', 'schema': 'er'},
+#     {'name': 'lite', 'url': 'https://...', 'token': '...', 'schema': 'litellm'},
+# ]
+# Results are grouped by name, which defaults to the url.
+ENDPOINTS = [
+    {**endpoint, 'name': endpoint.get('name') or endpoint['url']}
+    for endpoint in getattr(settings, 'ENDPOINTS', None) or []
+] or [
+    {'name': '', 'url': settings.API_URL, 'token': settings.TOKEN, 'schema': 'er'},
+]
+TIMEOUT_SECONDS = 10
+CACHE_PATH = os.path.expanduser('~/.cache/list_models.json')
+CACHE_TTL_SECONDS = 10 * 60
+BENCHMARK_PROMPTS = [
+    'Write one sentence about the history of London.',
+    'List five prime numbers and explain why they are prime.',
+    'Summarise the plot of Hamlet in a short paragraph.',
+]
+BENCHMARK_REPORT_PATH = 'benchmark-{}.json'
+# generous, as the first token of a loaded model can take well over TIMEOUT_SECONDS
+BENCHMARK_TIMEOUT_SECONDS = 120
 
-def call_json_api(url, token, print_json=False):
+
+def run_action():
+    actions = _get_actions_info()
+    epilog = 'Actions:\n'
+    for name, info in actions.items():
+        epilog += f'  {name}:\n    {info["description"]}\n'
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=epilog,
+        description='List the models behind LLM APIs.'
+    )
+    parser.add_argument('action', help='action to perform', choices=actions.keys(), nargs='?', default='list')
+    parser.add_argument('-r', '--refresh', action='store_true', help=f'ignore cached responses (kept for {CACHE_TTL_SECONDS}s)')
+    parser.add_argument('-m', '--models', help='benchmark: comma separated names of the models to test (default: all)')
+    parser.add_argument('-p', '--prompts', help='benchmark: file with one prompt per line (default: a few short prompts)')
+    parser.add_argument('-c', '--concurrency', type=_positive_int, default=2, help='benchmark: number of simultaneous requests per model (default: 2)')
+    parser.add_argument('-n', '--repeat', type=_positive_int, default=2, help='benchmark: number of times each prompt is sent (default: 2)')
+    parser.add_argument('-t', '--max-tokens', type=_positive_int, default=128, help='benchmark: maximum number of tokens per response (default: 128)')
+    parser.add_argument('-T', '--timeout', type=_positive_int, default=BENCHMARK_TIMEOUT_SECONDS, help=f'benchmark: seconds to wait for each response (default: {BENCHMARK_TIMEOUT_SECONDS})')
+    parser.add_argument('-o', '--output', help='benchmark: path of the JSON report (default: benchmark-DATETIME.json)')
+    args = parser.parse_args()
+
+    actions[args.action]['function'](args)
+
+
+def _positive_int(value):
+    ret = int(value)
+    if ret < 1:
+        raise argparse.ArgumentTypeError(f'expected a number >= 1, got {value}')
+    return ret
+
+
+def _get_actions_info():
+    ret = {}
+    for k, v in globals().items():
+        if k.startswith('action_'):
+            name = k[7:]
+            description = (v.__doc__ or '').split('\n')[0]
+            ret[name] = {
+                'function': v,
+                'description': description
+            }
+    return ret
+
+
+def _open_api(url, token, data=None, timeout=TIMEOUT_SECONDS):
     ssl_context = None
     if 'localhost' in url:
         ssl_context = ssl._create_unverified_context()
@@ -16,9 +90,16 @@ def call_json_api(url, token, print_json=False):
         'User-Agent': 'Mozilla/5.0',
         'Authorization': f'Bearer {token}'
     }
+    if data is not None:
+        headers['Content-Type'] = 'application/json'
+        data = json.dumps(data).encode('utf-8')
+    request = urllib.request.Request(url, data=data, headers=headers)
+    return urllib.request.urlopen(request, context=ssl_context, timeout=timeout)
+
+
+def call_json_api(url, token, print_json=False):
     print(f'REQUEST {url}')
-    request = urllib.request.Request(url, headers=headers)
-    response = urllib.request.urlopen(request, context=ssl_context)
+    response = _open_api(url, token)
     res_str  = response.read().decode('utf-8')
     ret = json.loads(res_str)
 
@@ -27,21 +108,254 @@ def call_json_api(url, token, print_json=False):
 
     return ret
 
-print(datetime.now().isoformat())
 
-if IS_ER_API:
+def _adapt_er(res_dic):
     # openai/er api
-    res_dic = call_json_api(f"{API_URL}/v1/models", TOKEN)
-
+    ret = []
     for model in res_dic:
-        vision_status = 'VISION' if model["supports_vision"] else ''
-        print(f'{model["name"]:<15} {model["provider"]:<20} {model["backend_model"]:<30} {str(int(model["context_window"]/1024)):>6}k {vision_status:<6}')
-else:
-    # litellm api (used to be suuported by ER LLM platform)
-    res_dic = call_json_api(f"{API_URL}/model/info", TOKEN)
+        ret.append({
+            'name': model['name'],
+            'provider': model['provider'],
+            'backend_model': model['backend_model'],
+            'context_window': model['context_window'],
+            'vision': model['supports_vision'],
+        })
+    return ret
+
 
+def _adapt_litellm(res_dic):
+    # litellm api (used to be suuported by ER LLM platform)
+    ret = []
     for model in res_dic['data']:
-        params = model["litellm_params"]
-        info = model["model_info"]
-        vision_status = 'VISION' if info["supports_vision"] else ''
-        print(f'{model["model_name"]:<15} {params["model"]:<30} {info["backend_model"]:<25} {str(info["max_tokens"]):>7} {vision_status:<6}')
+        params = model['litellm_params']
+        info = model['model_info']
+        ret.append({
+            'name': model['model_name'],
+            'provider': params['model'],
+            'backend_model': info['backend_model'],
+            'context_window': info['max_tokens'] or 0,
+            'vision': info['supports_vision'],
+        })
+    return ret
+
+
+# schema: (path of the models listing, function converting its response to rows)
+SCHEMAS = {
+    'er': ('/v1/models', _adapt_er),
+    'litellm': ('/model/info', _adapt_litellm),
+}
+
+
+def fetch_models(endpoint):
+    """Returns the rows of models listed by an endpoint."""
+    path, adapt = SCHEMAS[endpoint['schema']]
+    return adapt(call_json_api(f"{endpoint['url']}{path}", endpoint['token']))
+
+
+def fetch_all_models(endpoints, refresh=False):
+    """Returns {endpoint name: rows}, fetching the endpoints concurrently.
+    Responses younger than CACHE_TTL_SECONDS are read from the cache.
+    If an endpoint fails or doesn't answer within TIMEOUT_SECONDS
+    its last cached rows are used, if any."""
+    cache = _read_cache()
+    now = time.time()
+    ret = {}
+
+    to_fetch = []
+    for endpoint in endpoints:
+        key = f"{endpoint['url']}|{endpoint['schema']}"
+        cached = cache.get(key)
+        if cached and not refresh and now - cached['time'] < CACHE_TTL_SECONDS:
+            ret[endpoint['name']] = cached['rows']
+        else:
+            to_fetch.append((endpoint, key))
+
+    if to_fetch:
+        # {key: rows or exception}
+        results = {}
+
+        def fetch(endpoint, key):
+            try:
+                results[key] = fetch_models(endpoint)
+            except Exception as e:
+                results[key] = e
+
+        # daemon threads, so a stalled endpoint doesn't hold the process at exit
+        # (the socket timeout applies to each read, not to the whole response)
+        threads = [threading.Thread(target=fetch, args=(endpoint, key), daemon=True) for endpoint, key in to_fetch]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + TIMEOUT_SECONDS
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+        for endpoint, key in to_fetch:
+            result = results.get(key, TimeoutError(f'no response within {TIMEOUT_SECONDS}s'))
+            if isinstance(result, Exception):
+                print(f"ERROR {endpoint['name'] or endpoint['url']}: {result}")
+                if key not in cache:
+                    continue
+                print(f"  using response cached at {datetime.fromtimestamp(cache[key]['time']).isoformat()}")
+            else:
+                cache[key] = {'time': now, 'rows': result}
+            ret[endpoint['name']] = cache[key]['rows']
+        _write_cache(cache)
+
+    return ret
+
+
+def _read_cache():
+    try:
+        with open(CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache):
+    tmp_path = f'{CACHE_PATH}.{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError as e:
+        print(f'WARNING: could not write the cache ({e})')
+
+
+def action_list(args):
+    """List the models of all the endpoints in one table (default action)."""
+    print(datetime.now().isoformat())
+
+    models = fetch_all_models(ENDPOINTS, args.refresh)
+
+    for endpoint in ENDPOINTS:
+        for model in models.get(endpoint['name'], []):
+            vision_status = 'VISION' if model['vision'] else ''
+            context = str(int(model['context_window'] / 1024))
+            prefix = f"{endpoint['name']:<10} " if len(ENDPOINTS) > 1 else ''
+            print(f"{prefix}{model['name']:<15} {model['provider']:<20} {model['backend_model']:<30} {context:>6}k {vision_status:<6}")
+
+
+def stream_chat(endpoint, model, prompt, max_tokens, timeout=BENCHMARK_TIMEOUT_SECONDS):
+    """Sends a streamed chat completion request.
+    Returns {'ttft': seconds to the first token, 'tokens_per_second': float, 'error': str}."""
+    ret = {'ttft': None, 'tokens_per_second': None, 'error': ''}
+    data = {
+        'model': model,
+        'messages': [{'role': 'user', 'content': prompt}],
+        'max_tokens': max_tokens,
+        'stream': True,
+        'stream_options': {'include_usage': True},
+    }
+    start = time.time()
+    first = None
+    chunks = 0
+    tokens = None
+    try:
+        response = _open_api(f"{endpoint['url']}/v1/chat/completions", endpoint['token'], data, timeout)
+        # server-sent events, one "data: {json}" line per chunk
+        for line in response:
+            line = line.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            line = line[5:].strip()
+            if line == '[DONE]':
+                break
+            chunk = json.loads(line)
+            if chunk.get('usage'):
+                tokens = chunk['usage'].get('completion_tokens')
+            for choice in chunk.get('choices') or []:
+                if (choice.get('delta') or {}).get('content'):
+                    chunks += 1
+                    if first is None:
+                        first = time.time()
+    except Exception as e:
+        ret['error'] = str(e)
+        return ret
+
+    end = time.time()
+    if first is None:
+        ret['error'] = 'no content in the response'
+        return ret
+
+    ret['ttft'] = first - start
+    tokens = tokens or chunks
+    if tokens > 1 and end > first:
+        ret['tokens_per_second'] = (tokens - 1) / (end - first)
+    return ret
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def _format_number(value, pattern='{:.2f}'):
+    return '-' if value is None else pattern.format(value)
+
+
+def action_benchmark(args):
+    """Measure time to first token, tokens/s and error rate of the listed models."""
+    prompts = BENCHMARK_PROMPTS
+    if args.prompts:
+        with open(args.prompts) as f:
+            prompts = [line.strip() for line in f if line.strip()]
+        if not prompts:
+            print(f'ERROR: no prompt in {args.prompts}')
+            return
+    selected = args.models.split(',') if args.models else None
+
+    models = fetch_all_models(ENDPOINTS, args.refresh)
+    report = {
+        'time': datetime.now().isoformat(),
+        'settings': {
+            'concurrency': args.concurrency,
+            'repeat': args.repeat,
+            'max_tokens': args.max_tokens,
+            'timeout': args.timeout,
+            'prompts': prompts,
+        },
+        'results': [],
+    }
+
+    print(f"{'endpoint':<10} {'model':<15} {'requests':>8} {'errors':>7} {'ttft p50':>9} {'ttft p90':>9} {'tok/s p50':>9}")
+    for endpoint in ENDPOINTS:
+        for model in models.get(endpoint['name'], []):
+            if selected and model['name'] not in selected:
+                continue
+            jobs = prompts * args.repeat
+            # models are tested one after the other so the concurrency is per model
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                samples = list(executor.map(
+                    lambda prompt: stream_chat(endpoint, model['name'], prompt, args.max_tokens, args.timeout), jobs
+                ))
+            ttfts = [s['ttft'] for s in samples if s['ttft'] is not None]
+            speeds = [s['tokens_per_second'] for s in samples if s['tokens_per_second'] is not None]
+            errors = [s['error'] for s in samples if s['error']]
+            result = {
+                'endpoint': endpoint['name'],
+                'model': model['name'],
+                'requests': len(samples),
+                'error_rate': len(errors) / len(samples),
+                'errors': sorted(set(errors)),
+                'ttft_p50': _percentile(ttfts, 50),
+                'ttft_p90': _percentile(ttfts, 90),
+                'tokens_per_second_p50': _percentile(speeds, 50),
+                'tokens_per_second_mean': sum(speeds) / len(speeds) if speeds else None,
+            }
+            report['results'].append(result)
+            print(f"{endpoint['name']:<10} {model['name']:<15} {len(samples):>8} {len(errors):>7} "
+                f"{_format_number(result['ttft_p50']):>9} {_format_number(result['ttft_p90']):>9} "
+                f"{_format_number(result['tokens_per_second_p50'], '{:.1f}'):>9}")
+
+    output = args.output or BENCHMARK_REPORT_PATH.format(datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report written to {output}')
+
+
+if __name__ == '__main__':
+    run_action()
@@ -1,15 +1,21 @@
 """Emails a list of unresponsive sites.
 The list is a recent snapshot obtained from UptimeRobot API.
+Each snapshot is also appended to a local history (sqlite) with hourly and
+daily rollups, from which the 'report' action computes availability.
 Please keep this script compatible with python 3.5.
 """
 
+import argparse
+import os
 import smtplib
+import sqlite3
 import urllib.request
 import urllib.parse
 import json
 import datetime
 import logging
 import sys
+import time
 from email.message import EmailMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -17,13 +23,47 @@ from env.uptime import EMAIL_SERVER, EMAIL_TO, EMAIL_FROM, UPTIME_API_KEY
 
 
 UPTIME_API_URL = 'https://api.uptimerobot.com/v2/getMonitors'
-UPTIME_REQUEST_PARAMS = urllib.parse.urlencode({
+UPTIME_REQUEST_PARAMS = {
   'api_key': UPTIME_API_KEY, 
   'format': 'json', 
   'logs': 1,
-  'statuses': '8-9',
-  'logs_limit': 5, 
-})
+  # enough logs for a flapping site between two runs, see _get_logs_start_date
+  'logs_limit': 100,
+  'limit': 50,
+}
+# UptimeRobot monitor statuses: 8 = seems down, 9 = down
+DOWN_STATUSES = [8, 9]
+# 0 = paused and 1 = not checked yet are left out of the history
+MONITORED_STATUSES = [2, 8, 9]
+# UptimeRobot log types: 1 = down
+LOG_TYPE_DOWN = 1
+HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'env', 'uptime.sqlite')
+DEFAULT_REPORT_DAYS = 30
+WORST_OFFENDERS_COUNT = 10
+HOUR_FORMAT = '%Y-%m-%dT%H'
+DAY_FORMAT = '%Y-%m-%d'
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS samples (
+  monitor TEXT, ts INTEGER, status INTEGER, duration INTEGER, reason TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+  monitor TEXT PRIMARY KEY, since INTEGER, ts INTEGER
+);
+CREATE TABLE IF NOT EXISTS incidents (
+  monitor TEXT, start INTEGER, duration INTEGER, resolved INTEGER,
+  PRIMARY KEY (monitor, start)
+);
+CREATE TABLE IF NOT EXISTS hourly (
+  monitor TEXT, bucket TEXT, monitored_seconds INTEGER DEFAULT 0, down_seconds INTEGER DEFAULT 0,
+  incidents INTEGER DEFAULT 0, repairs INTEGER DEFAULT 0, repair_seconds INTEGER DEFAULT 0,
+  PRIMARY KEY (monitor, bucket)
+);
+CREATE TABLE IF NOT EXISTS daily (
+  monitor TEXT, bucket TEXT, monitored_seconds INTEGER DEFAULT 0, down_seconds INTEGER DEFAULT 0,
+  incidents INTEGER DEFAULT 0, repairs INTEGER DEFAULT 0, repair_seconds INTEGER DEFAULT 0,
+  PRIMARY KEY (monitor, bucket)
+);
+'''
 
 
 class Logger:
@@ -75,6 +115,63 @@ class Emailer:
 
 LOGGER = Logger()
 
+def run_action():
+    actions = _get_actions_info()
+    epilog = 'Actions:\n'
+    for name, info in actions.items():
+        epilog += '  {}:\n    {}\n'.format(name, info['description'])
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=epilog,
+        description='Email down sites and report on their availability.'
+    )
+    parser.add_argument('action', help='action to perform', choices=actions.keys(), nargs='?', default='notify')
+    parser.add_argument('-s', '--start', help='start of the report window (UTC), YYYY-MM-DD or YYYY-MM-DDTHH')
+    parser.add_argument('-e', '--end', help='end of the report window (UTC), default: now')
+    parser.add_argument('-d', '--days', help='length of the report window if --start is not given', type=int, default=DEFAULT_REPORT_DAYS)
+    args = parser.parse_args()
+
+    actions[args.action]['function'](args)
+
+def _get_actions_info():
+    ret = {}
+    for k, v in sorted(globals().items()):
+        if k.startswith('action_'):
+            name = k[7:]
+            description = (v.__doc__ or '').split('\n')[0]
+            ret[name] = {
+                'function': v,
+                'description': description
+            }
+    return ret
+
+def fetch_monitors(logs_start_date=None):
+    """Returns all the monitors, one API page at a time,
+    with their logs since logs_start_date (unix time) if given."""
+    ret = []
+    params = dict(UPTIME_REQUEST_PARAMS)
+    if logs_start_date is not None:
+        params['logs_start_date'] = logs_start_date
+    while True:
+        params['offset'] = len(ret)
+        data = urllib.parse.urlencode(params).encode('ascii')
+        with urllib.request.urlopen(UPTIME_API_URL, data) as f:
+            res = json.loads(f.read().decode('utf-8'))
+
+        if res['stat'] != 'ok':
+            return None
+
+        ret += res['monitors']
+        if not res['monitors'] or len(ret) >= res['pagination']['total']:
+            break
+
+    return ret
+
+def action_notify(args):
+    """Email the list of down sites and record the snapshot (default action)."""
+    fetch_sites_list_and_email()
+
 def fetch_sites_list_and_email():
 
     LOGGER.log('start =========================')
@@ -84,15 +181,17 @@ def fetch_sites_list_and_email():
     monitors = []
 
     # fetch the list from the API
-    with urllib.request.urlopen(UPTIME_API_URL, UPTIME_REQUEST_PARAMS.encode('ascii')) as f:
-        res = f.read().decode('utf-8')
-
-    res = json.loads(res)
+    all_monitors = fetch_monitors(_get_logs_start_date())
 
-    if res['stat'] != 'ok':
+    if all_monitors is None:
         title = 'Uptime robot returned error'
     else:
-        monitors = res['monitors']
+        # the history must never prevent the alert
+        try:
+            record_history(all_monitors)
+        except Exception as e:
+            LOGGER.log('ERROR: could not record history ({}): {}'.format(HISTORY_PATH, e))
+        monitors = [m for m in all_monitors if m['status'] in DOWN_STATUSES]
 
     title = '{} site(s) down'.format(len(monitors))
 
@@ -115,5 +214,207 @@ def fetch_sites_list_and_email():
     
     LOGGER.log('done ==========================')
 
+def record_history(monitors, now=None):
+    """Appends one sample per active monitor to the history and updates the rollups.
+    Monitored time is the time between two samples of an active monitor.
+    Downtime comes from the down logs: each run adds the part of their
+    duration it has not seen yet, so outages shorter than the interval
+    between runs are counted too. An incident is repaired once a later log
+    or an up status follows it.
+    """
+    ts = int(now if now is not None else time.time())
+
+    conn = _connect_history()
+    with conn:
+        for monitor in monitors:
+            url = monitor['url']
+            status = monitor['status']
+            if status not in MONITORED_STATUSES:
+                # paused: monitored again from its next active sample
+                conn.execute('DELETE FROM state WHERE monitor = ?', (url,))
+                continue
+
+            # most recent first
+            logs = monitor.get('logs') or []
+            log = logs[0] if logs else {}
+            conn.execute(
+                'INSERT INTO samples VALUES (?, ?, ?, ?, ?)',
+                (url, ts, status, log.get('duration', 0), (log.get('reason') or {}).get('detail', ''))
+            )
+
+            row = conn.execute('SELECT since, ts FROM state WHERE monitor = ?', (url,)).fetchone()
+            if row is None:
+                since = ts
+            else:
+                since = row[0]
+                _add_interval(conn, url, row[1], ts, 'monitored_seconds')
+            conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)', (url, since, ts))
+
+            if row is not None and len(logs) >= UPTIME_REQUEST_PARAMS['logs_limit'] and logs[-1].get('datetime', 0) > row[1]:
+                LOGGER.log('WARNING: {} has more than {} logs since its last sample, its downtime is undercounted'.format(
+                    url, UPTIME_REQUEST_PARAMS['logs_limit']
+                ))
+
+            for i, log in enumerate(logs):
+                if log.get('type') != LOG_TYPE_DOWN:
+                    continue
+                start = log['datetime']
+                duration = log['duration']
+                if start + duration <= since:
+                    # before we started monitoring that site
+                    continue
+                resolved = i > 0 or status not in DOWN_STATUSES
+
+                known = conn.execute(
+                    'SELECT duration, resolved FROM incidents WHERE monitor = ? AND start = ?', (url, start)
+                ).fetchone()
+                if known is None:
+                    known = (0, 0)
+                    _add_to_buckets(conn, url, max(start, since), 'incidents', 1)
+
+                _add_interval(conn, url, max(start + known[0], since), start + duration, 'down_seconds')
+                if resolved and not known[1]:
+                    _add_to_buckets(conn, url, start + duration, 'repairs', 1)
+                    _add_to_buckets(conn, url, start + duration, 'repair_seconds', duration)
+
+                conn.execute(
+                    'INSERT OR REPLACE INTO incidents VALUES (?, ?, ?, ?)',
+                    (url, start, max(duration, known[0]), int(resolved))
+                )
+    conn.close()
+
+def _add_to_buckets(conn, url, ts, column, value):
+    """Adds value to the column of the hourly and daily buckets containing ts."""
+    moment = datetime.datetime.utcfromtimestamp(ts)
+    for table, bucket in [('hourly', moment.strftime(HOUR_FORMAT)), ('daily', moment.strftime(DAY_FORMAT))]:
+        conn.execute(
+            'INSERT OR IGNORE INTO {} (monitor, bucket) VALUES (?, ?)'.format(table),
+            (url, bucket)
+        )
+        conn.execute(
+            'UPDATE {0} SET {1} = {1} + ? WHERE monitor = ? AND bucket = ?'.format(table, column),
+            (value, url, bucket)
+        )
+
+def _add_interval(conn, url, start, end, column):
+    """Adds the seconds of [start, end) to the column of the buckets they fall in."""
+    while start < end:
+        next_hour = (start // 3600 + 1) * 3600
+        _add_to_buckets(conn, url, start, column, min(end, next_hour) - start)
+        start = next_hour
+
+def _get_logs_start_date():
+    """Returns the unix time since which the logs are needed to update the
+    history: the oldest last sample of a monitor, or the start of an
+    incident still open then. None if unknown, e.g. before the first run.
+    """
+    try:
+        conn = _connect_history()
+        last_sample = conn.execute('SELECT MIN(ts) FROM state').fetchone()[0]
+        open_incident = conn.execute(
+            'SELECT MIN(start) FROM incidents JOIN state USING (monitor) WHERE resolved = 0'
+        ).fetchone()[0]
+        conn.close()
+    except (sqlite3.Error, OSError) as e:
+        LOGGER.log('ERROR: could not read history ({}): {}'.format(HISTORY_PATH, e))
+        return None
+
+    dates = [date for date in [last_sample, open_incident] if date is not None]
+    return min(dates) if dates else None
+
+def _connect_history():
+    ret = sqlite3.connect(HISTORY_PATH)
+    ret.executescript(HISTORY_SCHEMA)
+    return ret
+
+def _parse_utc(value):
+    for fmt in [HOUR_FORMAT, DAY_FORMAT]:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('invalid date: {} (expected YYYY-MM-DD or YYYY-MM-DDTHH)'.format(value))
+
+def get_availability(start, end):
+    """Returns {monitor: [monitored_seconds, down_seconds, incidents, repairs, repair_seconds]}
+    over [start, end), hour-aligned.
+    Only the rollups are read: whole days from the daily table and the
+    partial days at either end of the window from the hourly table.
+    """
+    start = start.replace(minute=0, second=0, microsecond=0)
+    end = end.replace(minute=0, second=0, microsecond=0)
+    first_day = start.replace(hour=0)
+    if first_day < start:
+        first_day += datetime.timedelta(days=1)
+    last_day = end.replace(hour=0)
+
+    ranges = []
+    if first_day < last_day:
+        ranges.append(('hourly', start.strftime(HOUR_FORMAT), first_day.strftime(HOUR_FORMAT)))
+        ranges.append(('daily', first_day.strftime(DAY_FORMAT), last_day.strftime(DAY_FORMAT)))
+        ranges.append(('hourly', last_day.strftime(HOUR_FORMAT), end.strftime(HOUR_FORMAT)))
+    else:
+        ranges.append(('hourly', start.strftime(HOUR_FORMAT), end.strftime(HOUR_FORMAT)))
+
+    ret = {}
+    conn = _connect_history()
+    for table, low, high in ranges:
+        rows = conn.execute(
+            'SELECT monitor, SUM(monitored_seconds), SUM(down_seconds), SUM(incidents), SUM(repairs), SUM(repair_seconds) '
+            'FROM {} WHERE bucket >= ? AND bucket < ? GROUP BY monitor'.format(table),
+            (low, high)
+        )
+        for row in rows:
+            totals = ret.setdefault(row[0], [0, 0, 0, 0, 0])
+            for i, value in enumerate(row[1:]):
+                totals[i] += value
+    conn.close()
+
+    return ret
+
+def action_report(args):
+    """Print availability %, MTTR and the worst offenders over a time window."""
+    end = _parse_utc(args.end) if args.end else datetime.datetime.utcnow()
+    start = _parse_utc(args.start) if args.start else end - datetime.timedelta(days=args.days)
+
+    availability = get_availability(start, end)
+
+    print('Window (UTC): {} - {}'.format(start.strftime(HOUR_FORMAT), end.strftime(HOUR_FORMAT)))
+    if not availability:
+        print('No history in that window.')
+        return
+
+    totals = [sum(values) for values in zip(*availability.values())]
+    print('Monitors: {}, availability: {}, incidents: {}, MTTR: {}'.format(
+        len(availability), _format_availability(totals), totals[2], _format_mttr(totals)
+    ))
+
+    print('\nWorst offenders:')
+    print('{:>8} {:>9} {:>10}  {}'.format('avail.', 'incidents', 'MTTR', 'site'))
+    worst = sorted(availability.items(), key=lambda item: (_get_availability_ratio(item[1]), -item[1][2]))
+    for url, values in worst[:WORST_OFFENDERS_COUNT]:
+        if not values[1]:
+            break
+        print('{:>8} {:>9} {:>10}  {}'.format(
+            _format_availability(values), values[2], _format_mttr(values), url
+        ))
+
+def _get_availability_ratio(values):
+    if not values[0]:
+        return 1.0
+    # downtime can straddle the window edges
+    return max(0.0, 1.0 - float(values[1]) / values[0])
+
+def _format_availability(values):
+    if not values[0]:
+        return '-'
+    return '{:.2f}%'.format(100.0 * _get_availability_ratio(values))
+
+def _format_mttr(values):
+    if not values[3]:
+        return '-'
+    return str(datetime.timedelta(seconds=values[4] // values[3]))
+
 
-fetch_sites_list_and_email()
+if __name__ == '__main__':
+    run_action()
@@ -0,0 +1,16 @@
+/*
+Worker thread comparing pairs of screenshots sent by vireg.mjs.
+Message in: [latestPath, baselinePath, diffPath]
+Message out: { same: boolean } or { error: string }
+*/
+
+import { parentPort } from 'worker_threads';
+import { compareScreenshots } from './compare.mjs';
+
+parentPort.on('message', (paths) => {
+  try {
+    parentPort.postMessage({ same: compareScreenshots(...paths) });
+  } catch (err) {
+    parentPort.postMessage({ error: err.message });
+  }
+});
@@ -0,0 +1,163 @@
+/*
+Screenshot comparison, run in worker threads by vireg.mjs (see compare-worker.mjs).
+*/
+
+import fs from "fs";
+import crypto from "crypto";
+import {PNG} from 'pngjs';
+import pixelmatch from 'pixelmatch';
+
+const PIXELMATCH_OPTIONS = { threshold: 0.1 };
+// Unchanged rows added around each changed row so that pixelmatch's
+// anti-aliasing detection (which looks up to 2 pixels away) sees the
+// same neighbours as when it compares the whole image.
+const BAND_MARGIN_ROWS = 3;
+// pixelmatch's default opacity of the unchanged pixels in the diff image
+const DIFF_ALPHA = 0.1;
+
+function hashContent(buffer) {
+  return crypto.createHash('sha1').update(buffer).digest('hex');
+}
+
+export function compareScreenshots(imagePath1, imagePath2, diffImagePath) {
+  const image1 = fs.readFileSync(imagePath1);
+  const image2 = fs.readFileSync(imagePath2);
+
+  // identical files: no need to decode them
+  if (image1.length === image2.length && hashContent(image1) === hashContent(image2)) {
+    return true;
+  }
+
+  const img1 = PNG.sync.read(image1);
+  const img2 = PNG.sync.read(image2);
+
+  if (img1.width !== img2.width || img1.height !== img2.height) {
+    console.log('Images have different dimensions.');
+    const maxWidth = Math.max(img1.width, img2.width);
+    const maxHeight = Math.max(img1.height, img2.height);
+    const overlapWidth = Math.min(img1.width, img2.width);
+    const overlapHeight = Math.min(img1.height, img2.height);
+
+    const diffImg = new PNG({ width: maxWidth, height: maxHeight });
+    const RED = [255, 0, 0, 255];
+
+    function fillRect(data, imgWidth, x, y, w, h, color) {
+      for (let row = y; row < y + h; row++) {
+        for (let col = x; col < x + w; col++) {
+          const idx = (row * imgWidth + col) * 4;
+          data[idx] = color[0];
+          data[idx + 1] = color[1];
+          data[idx + 2] = color[2];
+          data[idx + 3] = color[3];
+        }
+      }
+    }
+
+    if (maxWidth > img1.width) {
+      fillRect(diffImg.data, maxWidth, img1.width, 0, maxWidth - img1.width, img1.height, RED);
+    }
+    if (maxHeight > img1.height) {
+      fillRect(diffImg.data, maxWidth, 0, img1.height, maxWidth, maxHeight - img1.height, RED);
+    }
+    if (maxWidth > img2.width) {
+      fillRect(diffImg.data, maxWidth, img2.width, 0, maxWidth - img2.width, img2.height, RED);
+    }
+    if (maxHeight > img2.height) {
+      fillRect(diffImg.data, maxWidth, 0, img2.height, maxWidth, maxHeight - img2.height, RED);
+    }
+
+    if (overlapWidth > 0 && overlapHeight > 0) {
+      const crop1 = Buffer.alloc(overlapWidth * overlapHeight * 4);
+      const crop2 = Buffer.alloc(overlapWidth * overlapHeight * 4);
+      const overlapDiff = Buffer.alloc(overlapWidth * overlapHeight * 4);
+
+      for (let y = 0; y < overlapHeight; y++) {
+        const srcRowStart = y * img1.width * 4;
+        const dstRowStart = y * overlapWidth * 4;
+        crop1.set(img1.data.subarray(srcRowStart, srcRowStart + overlapWidth * 4), dstRowStart);
+      }
+      for (let y = 0; y < overlapHeight; y++) {
+        const srcRowStart = y * img2.width * 4;
+        const dstRowStart = y * overlapWidth * 4;
+        crop2.set(img2.data.subarray(srcRowStart, srcRowStart + overlapWidth * 4), dstRowStart);
+      }
+
+      const diffCount = pixelmatch(crop1, crop2, overlapDiff, overlapWidth, overlapHeight, PIXELMATCH_OPTIONS);
+
+      for (let y = 0; y < overlapHeight; y++) {
+        const srcRowStart = y * overlapWidth * 4;
+        const dstRowStart = y * maxWidth * 4;
+        diffImg.data.set(overlapDiff.subarray(srcRowStart, srcRowStart + overlapWidth * 4), dstRowStart);
+      }
+    }
+
+    fs.writeFileSync(diffImagePath, PNG.sync.write(diffImg));
+    return false;
+  }
+
+  const bands = getChangedBands(img1.data, img2.data, img1.width, img1.height);
+  if (!bands.length) {
+    return true;
+  }
+
+  const diffImg = new PNG({ width: img1.width, height: img1.height });
+
+  const diffCount = matchBands(img1.data, img2.data, diffImg.data, img1.width, bands);
+
+  if (diffCount > 0) {
+    fs.writeFileSync(diffImagePath, PNG.sync.write(diffImg));
+    return false;
+  }
+
+  return true;
+}
+
+function getChangedBands(data1, data2, width, height) {
+  /*
+  Returns the [firstRow, endRow) ranges around the rows whose pixels differ,
+  merged when they touch.
+  */
+  const ret = [];
+  const rowLength = width * 4;
+  for (let y = 0; y < height; y++) {
+    const start = y * rowLength;
+    if (data1.compare(data2, start, start + rowLength, start, start + rowLength) !== 0) {
+      const bandStart = Math.max(0, y - BAND_MARGIN_ROWS);
+      const bandEnd = Math.min(height, y + BAND_MARGIN_ROWS + 1);
+      const last = ret[ret.length - 1];
+      if (last && bandStart <= last[1]) {
+        last[1] = bandEnd;
+      } else {
+        ret.push([bandStart, bandEnd]);
+      }
+    }
+  }
+  return ret;
+}
+
+function matchBands(data1, data2, diffData, width, bands) {
+  /*
+  Writes to diffData the same image as pixelmatch on the whole images
+  but only runs pixelmatch on the changed bands.
+  The other rows are drawn faded, as pixelmatch draws identical pixels.
+  */
+  for (let i = 0; i < data1.length; i += 4) {
+    const y = data1[i] * 0.29889531 + data1[i + 1] * 0.58662247 + data1[i + 2] * 0.11448223;
+    const value = 255 + (y - 255) * DIFF_ALPHA * data1[i + 3] / 255;
+    diffData[i] = diffData[i + 1] = diffData[i + 2] = value;
+    diffData[i + 3] = 255;
+  }
+
+  let ret = 0;
+  const rowLength = width * 4;
+  for (const [start, end] of bands) {
+    // rows are contiguous, so a band is a view on the same buffer
+    const from = start * rowLength;
+    const to = end * rowLength;
+    ret += pixelmatch(
+      data1.subarray(from, to), data2.subarray(from, to), diffData.subarray(from, to),
+      width, end - start, PIXELMATCH_OPTIONS
+    );
+  }
+  return ret;
+}
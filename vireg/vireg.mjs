@@ -17,8 +17,8 @@ import fs from "fs";
 import path from "path";
 import { Liquid } from 'liquidjs';
 import csvParser from 'csv-parser';
-import {PNG} from 'pngjs';
-import pixelmatch from 'pixelmatch';
+import os from "os";
+import { Worker } from 'worker_threads';
 
 const __dirname = import.meta.dirname;
 
@@ -38,11 +38,17 @@ const REPORT_TEMPLATE_PATH = path.join(__dirname, 'report-template.liquid');
 const CAPTURE_FULL_PAGE = true;
 const PRE_SCREENSHOT_DELAY = 1000;
 const IMAGE_LOAD_TIMEOUT_MILISECS = 10000;
+// number of pages screenshotting in parallel, each in its own browser context
+const DEFAULT_CONCURRENCY = parseInt(process.env.VIREG_CONCURRENCY || '1', 10);
+// number of worker threads comparing screenshots in the diff action
+const DIFF_WORKERS = parseInt(process.env.VIREG_DIFF_WORKERS || '0', 10) || os.availableParallelism();
+const COMPARE_WORKER_PATH = path.join(__dirname, 'compare-worker.mjs');
 
 class VisualRegressionToolkit {
   constructor() {
     this.rows = [];
     this.urls = [];
+    this.concurrency = DEFAULT_CONCURRENCY;
   }
 
   resolveDomain() {
@@ -98,9 +104,7 @@ class VisualRegressionToolkit {
     this.styleSheetContent = this.readStyleSheet()
 
     this.browser = await chromium.launch({ headless: true });
-    const context = await this.browser.newContext();
-    this.webPage = await context.newPage();
-    await this.webPage.setViewportSize(VIEWPORT);
+    this.webPage = await this.newWebPage();
 
     // ensure diff directory exists
     if (!fs.existsSync(SCREENSHOTS_DIFF_PATH)) {
@@ -108,6 +112,26 @@ class VisualRegressionToolkit {
     }
   }
 
+  async newWebPage() {
+    // isolated context: no cookies or cache shared with other pages
+    const context = await this.browser.newContext({ viewport: VIEWPORT });
+    return await context.newPage();
+  }
+
+  readOptions(args) {
+    // --concurrency N
+    const index = args.indexOf('--concurrency');
+    if (index > -1) {
+      const value = parseInt(args[index + 1], 10);
+      if (!(value > 0)) {
+        console.log('--concurrency requires a positive number.');
+        return false;
+      }
+      this.concurrency = value;
+    }
+    return true;
+  }
+
   async uninit() {
     await this.browser.close()
   }
@@ -132,6 +156,10 @@ class VisualRegressionToolkit {
     if (args.length > 0) {
       const action = args[0];
 
+      if (!this.readOptions(args.slice(1))) {
+        return;
+      }
+
       await this.init()
 
       switch (action) {
@@ -183,8 +211,34 @@ class VisualRegressionToolkit {
   async actionFetch() {
     this.removeScreenshots(SCREENSHOTS_LATEST_PATH)
 
+    // Several URLs can map to the same file; keep the last one, as a
+    // sequential run would, so parallel pages never race on a file.
+    const configsByFile = new Map();
     for (const urlConfig of this.urls) {
-      await this.takeScreenshot(urlConfig)
+      const filename = this.getScreenshotFilenameFromURL(`${this.domain}${urlConfig.url}`);
+      configsByFile.delete(filename);
+      configsByFile.set(filename, urlConfig);
+    }
+    const urlConfigs = [...configsByFile.values()];
+
+    const pages = [this.webPage];
+    while (pages.length < Math.min(this.concurrency, urlConfigs.length)) {
+      pages.push(await this.newWebPage());
+    }
+    if (pages.length > 1) {
+      console.log(`Fetching with ${pages.length} pages in parallel`);
+    }
+
+    // each page takes the next URL from the list until none is left
+    let next = 0;
+    await Promise.all(pages.map(async (page) => {
+      while (next < urlConfigs.length) {
+        await this.takeScreenshot(urlConfigs[next++], page);
+      }
+    }));
+
+    for (const page of pages.slice(1)) {
+      await page.context().close();
     }
   }
 
@@ -218,21 +272,25 @@ class VisualRegressionToolkit {
       const latestFiles = new Set(fs.readdirSync(SCREENSHOTS_LATEST_PATH));
       const baselineFiles = new Set(fs.readdirSync(SCREENSHOTS_BASELINE_PATH));
 
-      for (const file of latestFiles) {
-        if (file.endsWith('.png') && baselineFiles.has(file)) {
-          const screenshotPath1 = path.join(SCREENSHOTS_LATEST_PATH, file);
-          const screenshotPath2 = path.join(SCREENSHOTS_BASELINE_PATH, file);
-          const diffScreenshotPath = path.join(SCREENSHOTS_DIFF_PATH, file);
-
-          const result = await this.compareScreenshots(screenshotPath1, screenshotPath2, diffScreenshotPath);
-
-          console.log(`${result ? 'SAME' : 'DIFF'} ${file}`);
-          comparedPairs++;
-          if (!result) {
-            differentPairs++;
-          }
+      const files = [...latestFiles].filter(file => file.endsWith('.png') && baselineFiles.has(file));
+      const results = await this.compareScreenshotsInWorkers(files.map(file => [
+        path.join(SCREENSHOTS_LATEST_PATH, file),
+        path.join(SCREENSHOTS_BASELINE_PATH, file),
+        path.join(SCREENSHOTS_DIFF_PATH, file),
+      ]));
+
+      // reported in file order, whichever worker finished first
+      files.forEach((file, i) => {
+        const result = results[i];
+        if (result.error) {
+          console.error(`Failed to compare ${file}: ${result.error}`);
         }
-      }
+        console.log(`${result.same ? 'SAME' : 'DIFF'} ${file}`);
+        comparedPairs++;
+        if (!result.same) {
+          differentPairs++;
+        }
+      });
 
       console.log(`Compared pairs: ${comparedPairs}`);
       console.log(`Different pairs: ${differentPairs}`);
@@ -242,103 +300,49 @@ class VisualRegressionToolkit {
     }
   }
 
-  async compareScreenshots(imagePath1, imagePath2, diffImagePath) {
-    const image1 = fs.readFileSync(imagePath1);
-    const image2 = fs.readFileSync(imagePath2);
-
-    const img1 = PNG.sync.read(image1);
-    const img2 = PNG.sync.read(image2);
-
-    if (img1.width !== img2.width || img1.height !== img2.height) {
-      console.log('Images have different dimensions.');
-      const maxWidth = Math.max(img1.width, img2.width);
-      const maxHeight = Math.max(img1.height, img2.height);
-      const overlapWidth = Math.min(img1.width, img2.width);
-      const overlapHeight = Math.min(img1.height, img2.height);
-
-      const diffImg = new PNG({ width: maxWidth, height: maxHeight });
-      const RED = [255, 0, 0, 255];
-
-      function fillRect(data, imgWidth, x, y, w, h, color) {
-        for (let row = y; row < y + h; row++) {
-          for (let col = x; col < x + w; col++) {
-            const idx = (row * imgWidth + col) * 4;
-            data[idx] = color[0];
-            data[idx + 1] = color[1];
-            data[idx + 2] = color[2];
-            data[idx + 3] = color[3];
-          }
-        }
-      }
-
-      if (maxWidth > img1.width) {
-        fillRect(diffImg.data, maxWidth, img1.width, 0, maxWidth - img1.width, img1.height, RED);
-      }
-      if (maxHeight > img1.height) {
-        fillRect(diffImg.data, maxWidth, 0, img1.height, maxWidth, maxHeight - img1.height, RED);
-      }
-      if (maxWidth > img2.width) {
-        fillRect(diffImg.data, maxWidth, img2.width, 0, maxWidth - img2.width, img2.height, RED);
-      }
-      if (maxHeight > img2.height) {
-        fillRect(diffImg.data, maxWidth, 0, img2.height, maxWidth, maxHeight - img2.height, RED);
-      }
-
-      if (overlapWidth > 0 && overlapHeight > 0) {
-        const crop1 = Buffer.alloc(overlapWidth * overlapHeight * 4);
-        const crop2 = Buffer.alloc(overlapWidth * overlapHeight * 4);
-        const overlapDiff = Buffer.alloc(overlapWidth * overlapHeight * 4);
-
-        for (let y = 0; y < overlapHeight; y++) {
-          const srcRowStart = y * img1.width * 4;
-          const dstRowStart = y * overlapWidth * 4;
-          crop1.set(img1.data.subarray(srcRowStart, srcRowStart + overlapWidth * 4), dstRowStart);
-        }
-        for (let y = 0; y < overlapHeight; y++) {
-          const srcRowStart = y * img2.width * 4;
-          const dstRowStart = y * overlapWidth * 4;
-          crop2.set(img2.data.subarray(srcRowStart, srcRowStart + overlapWidth * 4), dstRowStart);
-        }
-
-        const diffCount = pixelmatch(crop1, crop2, overlapDiff, overlapWidth, overlapHeight, { threshold: 0.1 });
+  async compareScreenshotsInWorkers(pairs) {
+    /*
+    Compares each [latestPath, baselinePath, diffPath] in a pool of worker
+    threads (see compare.mjs). Returns a { same, error } per pair, in order.
+    */
+    const ret = new Array(pairs.length);
+    const workerCount = Math.min(DIFF_WORKERS, pairs.length);
+    let next = 0;
 
-        for (let y = 0; y < overlapHeight; y++) {
-          const srcRowStart = y * overlapWidth * 4;
-          const dstRowStart = y * maxWidth * 4;
-          diffImg.data.set(overlapDiff.subarray(srcRowStart, srcRowStart + overlapWidth * 4), dstRowStart);
+    await Promise.all(Array.from({ length: workerCount }, async () => {
+      const worker = new Worker(COMPARE_WORKER_PATH);
+      try {
+        while (next < pairs.length) {
+          const i = next++;
+          ret[i] = await new Promise((resolve, reject) => {
+            worker.once('message', resolve);
+            worker.once('error', reject);
+            worker.postMessage(pairs[i]);
+          });
+          worker.removeAllListeners('error');
         }
+      } finally {
+        await worker.terminate();
       }
+    }));
 
-      fs.writeFileSync(diffImagePath, PNG.sync.write(diffImg));
-      return false;
-    }
-
-    const diffImg = new PNG({ width: img1.width, height: img1.height });
-
-    const diffCount = pixelmatch(img1.data, img2.data, diffImg.data, img1.width, img1.height, { threshold: 0.1 });
-
-    if (diffCount > 0) {
-      fs.writeFileSync(diffImagePath, PNG.sync.write(diffImg));
-      return false;
-    }
-
-    return true;
+    return ret;
   }
 
-  async waitForImagesLoaded() {
+  async waitForImagesLoaded(page = this.webPage) {
     let ret = true
     try {
       // naturalWidth > 0 means the image finished loading and actually decoded
       // (a broken/404 image reports naturalWidth === 0, so we time out and warn
       // rather than fail the whole run).
-      await this.webPage.waitForFunction(
+      await page.waitForFunction(
         () => [...document.images].every(img => img.complete && img.naturalWidth > 0),
         null,
         { timeout: IMAGE_LOAD_TIMEOUT_MILISECS }
       );
     } catch (err) {
       ret = false
-      const missingCount = await this.webPage.evaluate(() =>
+      const missingCount = await page.evaluate(() =>
         [...document.images]
           .filter(img => !img.complete || img.naturalWidth === 0)
           .length
@@ -348,7 +352,7 @@ class VisualRegressionToolkit {
     return ret;
   }
 
-  async takeScreenshot(urlConfig) {
+  async takeScreenshot(urlConfig, page = this.webPage) {
     const { url, delay, waitFor } = urlConfig;
     const fullUrl = `${this.domain}${url}`;
     let screenshotPath = path.join(SCREENSHOTS_LATEST_PATH, this.getScreenshotFilenameFromURL(fullUrl));
@@ -360,17 +364,17 @@ class VisualRegressionToolkit {
 
     try {
       const TIMEOUT_DEFAULT_MILISECS = 10000
-      await this.webPage.goto(fullUrl, { timeout: TIMEOUT_DEFAULT_MILISECS })
+      await page.goto(fullUrl, { timeout: TIMEOUT_DEFAULT_MILISECS })
       if (actualDelay > 0) {
-        await this.webPage.waitForTimeout(actualDelay);
+        await page.waitForTimeout(actualDelay);
       }
-      await this.webPage.waitForLoadState('networkidle', { timeout: TIMEOUT_DEFAULT_MILISECS })
-      await this.webPage.waitForLoadState('domcontentloaded', { timeout: TIMEOUT_DEFAULT_MILISECS })
+      await page.waitForLoadState('networkidle', { timeout: TIMEOUT_DEFAULT_MILISECS })
+      await page.waitForLoadState('domcontentloaded', { timeout: TIMEOUT_DEFAULT_MILISECS })
       
       // Wait for specific selector if configured
       if (waitFor) {
         try {
-          await this.webPage.waitForSelector(waitFor, { timeout: TIMEOUT_DEFAULT_MILISECS });
+          await page.waitForSelector(waitFor, { timeout: TIMEOUT_DEFAULT_MILISECS });
           console.log(`  Waited for selector: ${waitFor}`);
         } catch (err) {
           console.warn(`  Selector '${waitFor}' not found, falling back to delay`);
@@ -379,14 +383,14 @@ class VisualRegressionToolkit {
       
 
       try {
-        await this.webPage.evaluate(() => document.fonts.ready);
+        await page.evaluate(() => document.fonts.ready);
       } catch (err) {
         console.warn(`  document.fonts.ready failed: ${err.message}`);
       }
 
-      await this.waitForImagesLoaded();
+      await this.waitForImagesLoaded(page);
 
-      await this.webPage.screenshot({
+      await page.screenshot({
         path: screenshotPath,
         animations: 'disabled',
         style: this.styleSheetContent,